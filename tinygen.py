@@ -1,9 +1,24 @@
 import os
+import io
+import re
+import ast
+import json
+import mmap
+import asyncio
+import itertools
+import hashlib
 import tempfile
+import zipfile
 import logging
+from pathlib import Path
+from urllib.parse import urlparse
 from fastapi import FastAPI, HTTPException
 from git import Repo
+import diskcache
+import httpx
 import anthropic
+from unidiff import PatchSet
+from unidiff.errors import UnidiffParseError
 import dotenv
 from pydantic import BaseModel
 
@@ -11,7 +26,12 @@ from pydantic import BaseModel
 dotenv.load_dotenv()
 
 app = FastAPI()
-client = anthropic.Anthropic()
+
+# one shared HTTP/2 connection pool for all Anthropic calls: the per-request
+# passes multiplex over a single TCP+TLS connection instead of paying repeated
+# handshakes, and the pool is sized for concurrent /analyze/ requests
+http_client = httpx.AsyncClient(http2=True, limits=httpx.Limits(max_connections=64))
+client = anthropic.AsyncAnthropic(http_client=http_client)
 
 # YOU CAN SWITCH BETWEEN CLAUDE 3 SONNET AND OPUS
 # Opus does overload more and is slower + more expensive, but more powerful
@@ -21,6 +41,26 @@ model = "claude-3-sonnet-20240229"
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# on-disk cache of LLM results so repeat calls skip the pipeline entirely
+cache = diskcache.Cache(os.path.expanduser("~/.tinygen/cache"))
+CACHE_EXPIRE_SECONDS = 86400
+
+# ingestion limits: the LLM can't use binaries or huge blobs, so skip them
+# early and keep both memory and prompt size bounded
+MAX_FILE_BYTES = 65536
+MAX_CONTEXT_BYTES = 524288
+BINARY_SNIFF_BYTES = 8192
+# files above this size are read through mmap instead of a heap buffer
+MMAP_MIN_BYTES = 32768
+SKIPPED_EXTENSIONS = {".zip", ".png", ".jpg", ".pdf", ".woff", ".lock", ".min.js", ".map"}
+
+# files below this size go into the analysis context verbatim; larger ones
+# are reduced to a structural summary
+SUMMARIZE_MIN_BYTES = 2048
+# repos whose full context fits under this can skip summarization and run
+# the speculative parallel passes on the raw code base instead
+SPECULATE_MAX_CONTEXT_BYTES = 65536
+
 '''
 IMPROVING THE AI SYSTEM FOR LARGER CODE BASES: Proposal
 1. the first walk through creates a context string explaining the code base and depencies on other files at each part in the heirarchy.
@@ -122,77 +162,278 @@ Notice that there is no output. Is this supposed to work on Windows also?
 Also it might be great if the script detects which OS or shell I'm using and try to use the appropriate command e.g. dir instead of ls because I don't want to be adding windows after every prompt.                     
 """
 
-def add_context(code: str, path: str) -> str:
+# constant boilerplate around each file in the context string, precomputed
+# once so add_context never builds a per-file f-string
+CONTEXT_HEADER = "\n_____  \n\nREPO FILE PATH: \n"
+CONTEXT_MID = "\n\nFILE CONTENT:\n```\n"
+CONTEXT_FOOTER = "\n```\n\n____\n\n"
+
+
+def add_context(code: str, path: str) -> tuple:
     """
-    Returns the format for adding to the code context string.
+    Returns the pieces for adding to the code context string, ready to flow
+    into a single join.
     Args:
-        system (str): The code to add
+        code (str): The code to add
         path (str): the path to add
 
     Returns:
-        str: The added message.
+        tuple: The boilerplate and content pieces for this file.
     """
-    return f'''
-_____  
+    return (CONTEXT_HEADER, path, CONTEXT_MID, code, CONTEXT_FOOTER)
 
-REPO FILE PATH: 
-{path}
+_DIFF_FENCE_RE = re.compile(r"```(?:bash|diff)?\n(.*?)```", re.S)
 
-FILE CONTENT:
-```
-{code}
-```
 
-____
+def extract_diff(reply: str) -> str:
+    """
+    Pulls the diff out of the model reply's fenced block and validates that
+    it parses as a unified diff.
+    Args:
+        reply (str): The full model reply.
 
-'''
+    Returns:
+        str: The validated diff text.
 
-def add_content(context: str, prompt: str) -> str:
+    Raises:
+        ValueError: If the reply contains no fenced block, or the block
+            contains no diff (PatchSet parses arbitrary prose to an empty
+            patch set without raising).
+        UnidiffParseError: If the fenced block is not a valid unified diff.
     """
-    Returns the format for adding content to the user 
+    m = _DIFF_FENCE_RE.search(reply)
+    if m is None:
+        raise ValueError("no fenced diff block in reply")
+    diff = m.group(1)
+    if not PatchSet(diff):
+        raise ValueError("fenced block contains no unified diff")
+    return diff
+
+
+_DECLARATION_RE = re.compile(
+    r"^\s*(def |class |async def |function |const |let |var |export |public |private |interface |struct |fn |func )")
+
+
+def summarize(path: str, content: str) -> str:
+    """
+    Reduces a source file to a structural summary for the analysis pass:
+    signatures and docstrings instead of full bodies, plus a short content
+    hash so changed files stay distinguishable. Full bodies are re-injected
+    later only for the files the analysis pass flags.
     Args:
-        context (str): The context to add
-        prompt (str): The prompt to add
+        path (str): The repo-relative path of the file.
+        content (str): The full text of the file.
 
     Returns:
-        str: The added message.
+        str: The summary, or the full content for small files.
     """
-    return f"""
-CODE BASE:
+    if len(content) < SUMMARIZE_MIN_BYTES:
+        return content
+
+    digest = hashlib.sha256(content.encode()).hexdigest()[:12]
+    lines = [f"(structural summary; full body available on request; sha256 {digest})"]
+
+    if path.endswith(".py"):
+        try:
+            tree = ast.parse(content)
+        except SyntaxError:
+            tree = None
+        if tree is not None:
+            doc = ast.get_docstring(tree)
+            if doc:
+                lines.append(f'"""{doc.splitlines()[0]}"""')
+            for node in ast.walk(tree):
+                if isinstance(node, ast.ClassDef):
+                    lines.append(f"class {node.name}:")
+                    doc = ast.get_docstring(node)
+                    if doc:
+                        lines.append(f'    """{doc.splitlines()[0]}"""')
+                elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+                    args = ", ".join(a.arg for a in node.args.args)
+                    lines.append(f"{prefix} {node.name}({args}):")
+                    doc = ast.get_docstring(node)
+                    if doc:
+                        lines.append(f'    """{doc.splitlines()[0]}"""')
+            return "\n".join(lines)
+
+    # non-Python (or unparseable) files: keep declaration-looking lines, or a
+    # head preview when nothing matches
+    declarations = [l for l in content.splitlines() if _DECLARATION_RE.match(l)]
+    if declarations:
+        lines.extend(declarations)
+    else:
+        lines.extend(content.splitlines()[:20])
+    return "\n".join(lines)
+
+
+def build_context(files: dict) -> str:
+    """
+    Joins every file into the full code-base context string.
+    Args:
+        files (dict): Mapping of repo-relative path to file text.
+
+    Returns:
+        str: The concatenated context string.
+    """
+    return "".join(itertools.chain.from_iterable(
+        add_context(text, gp) for gp, text in files.items()))
 
-{context}
 
+def build_summary_context(files: dict) -> str:
+    """
+    Joins structural summaries of every file into a compact context string.
+    Args:
+        files (dict): Mapping of repo-relative path to file text.
+
+    Returns:
+        str: The concatenated summary context string.
+    """
+    return "".join(itertools.chain.from_iterable(
+        add_context(summarize(gp, text), gp) for gp, text in files.items()))
+
+
+def snapshot_fingerprint(files: dict, prompt: str) -> str:
+    """
+    Hashes the snapshot contents together with the prompt and model so an
+    identical request maps to the same cache key.
+    Args:
+        files (dict): Mapping of repo-relative path to file text.
+        prompt (str): The user prompt.
+
+    Returns:
+        str: The hex digest identifying this (snapshot, prompt, model) triple.
+    """
+    h = hashlib.sha256()
+    for gp, text in sorted(files.items()):
+        h.update(gp.encode())
+        h.update(hashlib.sha256(text.encode()).digest())
+    h.update(hashlib.sha256((prompt + model).encode()).digest())
+    return h.hexdigest()
+
+
+def add_content(context: str, prompt: str) -> list:
+    """
+    Returns the format for adding content to the user
+
+    The code base context goes in its own cacheable block so all three passes
+    reuse the same cached prefix, with the prompt appended as a separate block.
+    Args:
+        context (str): The context to add
+        prompt (str): The prompt to add
+
+    Returns:
+        list: The content blocks for the user message.
+    """
+    return [
+        {
+            "type": "text",
+            "text": f"\nCODE BASE:\n\n{context}\n",
+            "cache_control": {"type": "ephemeral"},
+        },
+        {
+            "type": "text",
+            "text": f"""
 
 _________________
 
 USER PROMPT
 Analyze changes to be made to this code base based on this prompt:
 {prompt}
-"""
+""",
+        },
+    ]
+
+
+# structured-output tool for the fused single-call pipeline: the model plans
+# and emits the diff in one prefill instead of three
+emit_patch_tool = {
+    "name": "emit_patch",
+    "description": "Emit the change plan and the unified diff that satisfies the user prompt.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "plan": {"type": "string"},
+            "diff": {"type": "string"},
+        },
+        "required": ["diff"],
+    },
+}
+
+
+async def a_send_patch(system: str, messages, max_tokens: int = 4096) -> dict:
+    """
+    Send a message to the selected Claude-3 model, forcing a structured
+    emit_patch tool call so the plan and diff come back in one round-trip.
+    Args:
+        system (str): The system string
+        messages: An array containing all the past messages so far.
+        max_tokens (int): The decode budget to reserve for the reply.
+
+    Returns:
+        dict: The emit_patch tool input, with "plan" and "diff" keys.
+    """
 
+    msg_key = "patch:" + hashlib.sha256(
+        json.dumps([model, system, messages, max_tokens], sort_keys=True).encode()).hexdigest()
+    cached = cache.get(msg_key)
+    if cached is not None:
+        return cached
 
-def send_message(system: str, messages) -> str:
+    msg = await client.messages.create(
+        model=model,
+        max_tokens=max_tokens,
+        temperature=0.0,
+        system=[{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}],
+        tools=[emit_patch_tool],
+        tool_choice={"type": "tool", "name": "emit_patch"},
+        messages=messages)
+    patch = None
+    for block in msg.content:
+        if block.type == "tool_use":
+            patch = block.input
+            break
+    if patch is None:
+        # no tool_use block (e.g. max_tokens truncation): don't memoize, or
+        # this request would be pinned to the multi-pass fallback for 24h
+        return {}
+    cache.set(msg_key, patch, expire=CACHE_EXPIRE_SECONDS)
+    return patch
+
+
+async def a_send_message(system: str, messages, max_tokens: int = 4096) -> str:
     """
-    Send a message to the selected Claude-3 model through Anthropic with streaming.
+    Send a message to the selected Claude-3 model through Anthropic.
     Args:
         system (str): The system string
         messages: An array containing all the past messages so far.
+        max_tokens (int): The decode budget to reserve for the reply.
 
     Returns:
         str: The Claude-3 generated message.
     """
 
-    reply = ''
-    with client.messages.stream(
+    # memoize each stage so a rerun of a partially-completed pipeline skips
+    # stages that already finished
+    msg_key = "msg:" + hashlib.sha256(
+        json.dumps([model, system, messages, max_tokens], sort_keys=True).encode()).hexdigest()
+    cached = cache.get(msg_key)
+    if cached is not None:
+        return cached
+
+    # nothing consumes tokens incrementally here, so a plain request avoids
+    # SSE framing and per-chunk overhead
+    msg = await client.messages.create(
         model=model,
-        max_tokens=4096,
+        max_tokens=max_tokens,
         temperature=0.0,
-        system=system,
-        messages=messages) as stream:
-            for text in stream.text_stream:
-                reply += text
-                print(text, end="", flush=True)
-    print()
+        # mark the system prompt as a cacheable prefix so repeat calls in the
+        # multi-pass pipeline pay the reduced cached-input rate
+        system=[{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}],
+        messages=messages)
+    reply = "".join(block.text for block in msg.content if block.type == "text")
+    logger.debug("reply length: %d chars", len(reply))
+    cache.set(msg_key, reply, expire=CACHE_EXPIRE_SECONDS)
     return reply
 
 
@@ -213,14 +454,212 @@ def clone_repository(repo_url: str, temp_dir: str) -> Repo:
         HTTPException: If an error occurs during repository cloning.
     """
     try:
-        repo = Repo.clone_from(repo_url, temp_dir)
+        # we only read the working tree, so skip history, tags and blobs we
+        # don't check out
+        repo = Repo.clone_from(
+            repo_url, temp_dir,
+            multi_options=["--depth=1", "--single-branch", "--no-tags", "--filter=blob:none"])
         return repo
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to clone repository: {str(e)}")
 
 
+def extract_zip_snapshot(data: bytes, temp_dir: str) -> None:
+    """
+    Extracts a GitHub archive ZIP into the temporary directory, stripping the
+    top-level folder GitHub wraps the snapshot in so paths match a clone.
+
+    Args:
+        data (bytes): The raw bytes of the downloaded ZIP archive.
+        temp_dir (str): The directory to extract the snapshot into.
+    """
+    temp_dir = os.path.abspath(temp_dir)
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for member in archive.infolist():
+            parts = member.filename.split('/', 1)
+            if len(parts) < 2 or not parts[1]:
+                continue
+            dst = os.path.abspath(os.path.join(temp_dir, parts[1]))
+            # Zip Slip guard: skip members that would escape the extraction dir
+            if os.path.commonpath([temp_dir, dst]) != temp_dir:
+                continue
+            if member.is_dir():
+                os.makedirs(dst, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                with open(dst, 'wb') as f:
+                    f.write(archive.read(member))
+
+
+async def fetch_repo_snapshot(repo_url: str, temp_dir: str) -> None:
+    """
+    Fetches a snapshot of the repository into a temporary directory.
+
+    For github.com URLs this downloads the codeload ZIP archive, which skips
+    git history and pack negotiation entirely. Other URLs fall back to a
+    regular git clone.
+
+    Args:
+        repo_url (str): The URL of the repository to fetch.
+        temp_dir (str): The path to the temporary directory to populate.
 
-def analyze_repo(repo_url: str, prompt: str) -> str:
+    Raises:
+        HTTPException: If the repository cannot be fetched.
+    """
+    parsed = urlparse(repo_url)
+    path_parts = [p for p in parsed.path.split('/') if p]
+    if parsed.netloc == "github.com" and len(path_parts) >= 2:
+        owner = path_parts[0]
+        repo = path_parts[1].removesuffix(".git")
+        async with httpx.AsyncClient(follow_redirects=True) as http:
+            for branch in ("main", "master"):
+                resp = await http.get(f"https://codeload.github.com/{owner}/{repo}/zip/refs/heads/{branch}")
+                if resp.status_code == 200:
+                    # extraction is CPU + blocking disk I/O; keep it off the
+                    # event loop so concurrent requests aren't stalled
+                    await asyncio.to_thread(extract_zip_snapshot, resp.content, temp_dir)
+                    return
+    # non-GitHub URL, or no main/master branch archive: fall back to git
+    await asyncio.to_thread(clone_repository, repo_url, temp_dir)
+
+
+def iter_files(root: str):
+    """
+    Walks a directory tree with os.scandir, skipping hidden entries inline.
+    DirEntry caches the stat result, so yielding the size is free for the
+    size filters downstream.
+    Args:
+        root (str): The directory to walk.
+
+    Yields:
+        tuple: (file path, size in bytes) for each non-hidden regular file.
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path, entry.stat().st_size
+
+
+def read_bytes(file_path: str) -> bytes:
+    """
+    Reads a file's raw bytes, memory-mapping the larger ones so the OS page
+    cache backs the data and can evict it under memory pressure instead of
+    holding a second copy on the Python heap.
+    Args:
+        file_path (str): The on-disk path of the file to read.
+
+    Returns:
+        bytes: The file contents.
+    """
+    if os.path.getsize(file_path) > MMAP_MIN_BYTES:
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm[:]
+    return Path(file_path).read_bytes()
+
+
+async def read_file(file_path: str, sem: asyncio.Semaphore) -> str:
+    """
+    Reads a single file without blocking the event loop.
+    Args:
+        file_path (str): The on-disk path of the file to read.
+        sem (asyncio.Semaphore): Semaphore bounding the number of concurrent reads.
+
+    Returns:
+        str: The decoded file text, or an empty string for binary files.
+    """
+    async with sem:
+        data = await asyncio.to_thread(read_bytes, file_path)
+    # binary sniff: a NUL byte near the start means this isn't text the
+    # model can use
+    if b'\x00' in data[:BINARY_SNIFF_BYTES]:
+        return ''
+    return data.decode('utf-8', 'replace')
+
+
+async def snapshot_etag(repo_url: str):
+    """
+    Returns the ETag of the GitHub archive for the repo's default branch via
+    a cheap HEAD request, or None for non-GitHub URLs. Used as a freshness
+    validator for the per-repo snapshot cache.
+    Args:
+        repo_url (str): The URL of the repository.
+
+    Returns:
+        str | None: The archive ETag, or None if unavailable.
+    """
+    parsed = urlparse(repo_url)
+    path_parts = [p for p in parsed.path.split('/') if p]
+    if parsed.netloc != "github.com" or len(path_parts) < 2:
+        return None
+    owner = path_parts[0]
+    repo = path_parts[1].removesuffix(".git")
+    async with httpx.AsyncClient(follow_redirects=True) as http:
+        for branch in ("main", "master"):
+            resp = await http.head(f"https://codeload.github.com/{owner}/{repo}/zip/refs/heads/{branch}")
+            if resp.status_code == 200:
+                return resp.headers.get("etag")
+    return None
+
+
+async def ingest_repo(repo_url: str) -> dict:
+    """
+    Fetches the repository snapshot and reads its files into a path-keyed
+    dict, reusing a cached snapshot when the archive ETag shows the repo is
+    unchanged since the last call.
+
+    Args:
+        repo_url (str): The URL of the repository to ingest.
+
+    Returns:
+        dict: Mapping of repo-relative path to file text.
+    """
+    repo_key = "repo:" + repo_url
+    etag = await snapshot_etag(repo_url)
+    cached = cache.get(repo_key)
+    if cached is not None and etag is not None and cached[0] == etag:
+        # unchanged repo: skip the download and every file read
+        return cached[1]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        await fetch_repo_snapshot(repo_url, temp_dir)
+
+        # collect the file paths first, then read them concurrently below
+        paths = []
+        total_bytes = 0
+        for file_path, size in iter_files(temp_dir):
+            name = os.path.basename(file_path)
+            if any(name.endswith(ext) for ext in SKIPPED_EXTENSIONS):
+                continue
+            if size > MAX_FILE_BYTES:
+                continue
+            total_bytes += size
+            paths.append((file_path, file_path[len(temp_dir) + 1:]))
+            if total_bytes > MAX_CONTEXT_BYTES:
+                break
+
+        # read everything in parallel, bounded by the semaphore
+        sem = asyncio.Semaphore(32)
+        texts = await asyncio.gather(
+            *[read_file(p, sem) for p, _ in paths],
+            return_exceptions=True)
+        for (p, _), text in zip(paths, texts):
+            if not isinstance(text, str):
+                logger.warning("Error reading %s: %s", p, text)
+        files = {gp: text for (_, gp), text in zip(paths, texts)
+                 if isinstance(text, str) and text}
+
+    if etag is not None:
+        cache.set(repo_key, (etag, files), expire=CACHE_EXPIRE_SECONDS)
+    return files
+
+
+async def analyze_repo(repo_url: str, prompt: str) -> str:
     """
     Clones the specified GitHub repository, analyzes the code using the Claude 3 API based on the provided prompt,
     generates a unified diff representing the suggested changes, and returns the diff as a string.
@@ -237,50 +676,113 @@ def analyze_repo(repo_url: str, prompt: str) -> str:
         HTTPException: If an error occurs during repository cloning, API communication, or analysis.
     """
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            repo = clone_repository(repo_url, temp_dir)
-
-            context = ""
-            original_root = next(os.walk(temp_dir))[0]
-
-            for root, dirs, files in os.walk(temp_dir):
-                files = [f for f in files if not f[0] == '.']
-                dirs[:] = [d for d in dirs if not d[0] == '.']
-                for file in files:
-                    git_file_path = os.path.join(root.split(original_root)[1], file)
-                    file_path = os.path.join(root, file)
-                    if file.endswith(".zip") or not os.access(file_path, os.R_OK):
-                        continue
-                    try:
-                        with open(file_path, 'r') as file:
-                            content = file.read()
-                            context = context + add_context(content, git_file_path)
-                    except Exception as e:
-                        print(f"Error reading {file_path}: {e}")
-            
+        files = await ingest_repo(repo_url)
+
+        # hash the snapshot contents with the prompt and model: an
+        # identical request can return the memoized diff without any LLM
+        # calls at all; hashing and context assembly are CPU-bound, so run
+        # them in a worker thread to keep the event loop free
+        diff_key = "diff:" + await asyncio.to_thread(snapshot_fingerprint, files, prompt)
+        cached_diff = cache.get(diff_key)
+        if cached_diff is not None:
+            return cached_diff
+
+        full_context = await asyncio.to_thread(build_context, files)
+        # dumping the full context forces a huge TTY write; only do it
+        # when debug logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(full_context)
+
+        if os.getenv("TINYGEN_MULTIPASS", "0") != "1":
+            # fused path: one structured call replaces analyze -> diff ->
+            # verify, paying a single prefill of the code base; the
+            # multi-pass pipeline below stays available for A/B comparison
+            # via TINYGEN_MULTIPASS=1 and as fallback on a bad diff
+            history = [
+                    {
+                        "role": "user",
+                        "content": add_content(full_context, prompt)
+                    }
+                ]
+            patch = await a_send_patch(simple_diff_generation_system, history)
+            diff = patch.get("diff", "")
+            if diff.strip():
+                try:
+                    # an empty patch set means the diff field held prose, not
+                    # a diff; treat it like a parse failure
+                    if not PatchSet(diff):
+                        raise ValueError("emit_patch diff contains no unified diff")
+                    cache.set(diff_key, diff, expire=CACHE_EXPIRE_SECONDS)
+                    return diff
+                except (ValueError, UnidiffParseError):
+                    logger.info("fused emit_patch diff failed to parse; falling back to multi-pass")
+
+        if len(full_context) <= SPECULATE_MAX_CONTEXT_BYTES:
+            # small repo: full bodies fit cheaply, so speculatively run the
+            # analysis pass and a direct diff-generation pass in parallel;
+            # both share the cached code-base prefix
+            history = [
+                    {
+                        "role": "user",
+                        "content": add_content(full_context, prompt)
+                    }
+                ]
+            analysis_reply, direct_reply = await asyncio.gather(
+                a_send_message(simple_code_analysis_system, history),
+                a_send_message(simple_diff_generation_system, history))
+
+            try:
+                # the direct pass already produced a parseable diff, so skip
+                # the analysis-fed generation round-trip entirely
+                extract_diff(direct_reply)
+                reply = direct_reply
+            except (ValueError, UnidiffParseError):
+                # fall back to feeding the analysis breakdown into diff generation
+                history.append({"role":"assistant", "content": analysis_reply})
+                history.append({"role":"user", "content": f"Now, generate the diff file based on what should be changed. Once again, the user prompt is: {prompt}"})
+                reply = await a_send_message(simple_diff_generation_system, history)
+        else:
+            # large repo: the analysis pass sees structural summaries only,
+            # then full bodies are injected just for the files it flagged
+            summary_context = await asyncio.to_thread(build_summary_context, files)
             history = [
                     {
-                        "role": "user", 
-                        "content": add_content(context, prompt)
+                        "role": "user",
+                        "content": add_content(summary_context, prompt)
                     }
-                ]   
-            print(context)
-            
-            # have it first add a breakdown explaining the code file and the possible changes that should be made
-            reply = send_message(simple_code_analysis_system, history)
-            history.append({"role":"assistant", "content": reply})            
-            history.append({"role":"user", "content": f"Now, generate the diff file based on what should be changed. Once again, the user prompt is: {prompt}"})
-            
-            # next, have it analyze the breakdown of the code base to produce a diff
-            reply = send_message(simple_diff_generation_system, history)
-            
-            # on the final step, make it verify the diff file then format it properly and save
-            history.append({"role":"assistant", "content": reply})            
-            history.append({"role":"user", "content": final_step_message + prompt})            
-            reply = send_message(simple_diff_generation_system, history)
-
-            # return the code formatted between the bash ticks
-            return reply.split("```bash\n")[1].split("\n```")[0]
+                ]
+            analysis_reply = await a_send_message(simple_code_analysis_system, history)
+
+            targets = [gp for gp in files if gp in analysis_reply]
+            bodies = "".join(itertools.chain.from_iterable(
+                add_context(files[gp], gp) for gp in targets))
+            history.append({"role":"assistant", "content": analysis_reply})
+            history.append({"role":"user", "content": f"Here are the full contents of the files you identified:\n{bodies}\nNow, generate the diff file based on what should be changed. Once again, the user prompt is: {prompt}"})
+            reply = await a_send_message(simple_diff_generation_system, history)
+
+        # the verify pass doubles latency and rarely changes the diff, so
+        # only run it when explicitly enabled
+        if os.getenv("TINYGEN_VERIFY", "0") == "1":
+            history.append({"role":"assistant", "content": reply})
+            history.append({"role":"user", "content": final_step_message + prompt})
+            # the verify pass re-emits the same diff, so size its decode
+            # budget off the diff we already have instead of reserving the
+            # full 4096 tokens
+            reply = await a_send_message(
+                simple_diff_generation_system, history,
+                max_tokens=min(4096, int(len(reply) / 3) + 256))
+
+        # extract and validate the diff; on a malformed reply, one cheap
+        # format-nudge retry replaces the old mandatory verify round-trip
+        try:
+            diff = extract_diff(reply)
+        except (ValueError, UnidiffParseError) as e:
+            history.append({"role":"assistant", "content": reply})
+            history.append({"role":"user", "content": f"Your diff failed to parse: {e}. Please re-emit only the diff."})
+            reply = await a_send_message(simple_diff_generation_system, history)
+            diff = extract_diff(reply)
+        cache.set(diff_key, diff, expire=CACHE_EXPIRE_SECONDS)
+        return diff
     
     except HTTPException:
         raise
@@ -290,7 +792,7 @@ def analyze_repo(repo_url: str, prompt: str) -> str:
 
 
 def test():
-    diff = analyze_repo("https://github.com/jayhack/llm.sh",test_prompt)
+    diff = asyncio.run(analyze_repo("https://github.com/jayhack/llm.sh",test_prompt))
     print("\n\nDIFF: \n\n" + diff)
 
 if __name__ == "__main__":
@@ -304,7 +806,38 @@ class Payload(BaseModel):
     prompt: str
 
 
+# in-flight pipelines keyed by request hash: a duplicate concurrent request
+# awaits the first one's future instead of running its own pipeline
+INFLIGHT: dict = {}
+
+
 @app.post("/analyze/")
 async def create_item(payload: Payload) -> str:
-    diff = analyze_repo(payload.repoUrl, payload.prompt)
-    return diff
\ No newline at end of file
+    key = hashlib.sha256((payload.repoUrl + payload.prompt + model).encode()).hexdigest()
+    existing = INFLIGHT.get(key)
+    if existing is not None:
+        return await existing
+
+    future = asyncio.get_running_loop().create_future()
+    INFLIGHT[key] = future
+    try:
+        diff = await analyze_repo(payload.repoUrl, payload.prompt)
+        future.set_result(diff)
+        return diff
+    except Exception as e:
+        future.set_exception(e)
+        # mark the exception retrieved in case no duplicate was waiting
+        future.exception()
+        raise
+    finally:
+        # the handler can be cancelled (client disconnect) without hitting the
+        # except clause above; cancel the future so waiting duplicates aren't
+        # left hanging on a key that no longer exists
+        if not future.done():
+            future.cancel()
+        del INFLIGHT[key]
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
\ No newline at end of file